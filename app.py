@@ -1,8 +1,18 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash
-from sqlalchemy import func, case
+import time
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from flask import Flask, render_template, request, redirect, url_for, flash, make_response, abort
+from flask_caching import Cache
+from flask_compress import Compress
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import func, case, insert, select, event, bindparam
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
 from models import db, Client, Product, Variant, Movement
 
+cache = Cache()
+compress = Compress()
+
 # --- Données par défaut ---
 DEFAULT_CLIENTS = [
     "Landerneau Football Club",
@@ -35,33 +45,213 @@ DEFAULT_VARIANTS = [
 ]
 
 def seed_if_empty():
-    if Client.query.count() == 0 and Product.query.count() == 0 and Variant.query.count() == 0:
-        # Clients
-        for c in DEFAULT_CLIENTS:
-            db.session.add(Client(name=c))
-        db.session.flush()
-        # Produits
-        prods = {}
-        for n in DEFAULT_PRODUCTS:
-            p = Product(name=n)
-            db.session.add(p)
-            prods[n] = p
-        db.session.flush()
-        # Variants
-        for name, size, price in DEFAULT_VARIANTS:
-            db.session.add(Variant(product_id=prods[name].id, size_l=size, price_ttc=price))
+    # Tables vides ? un seul aller-retour, EXISTS s'arrête à la première ligne
+    empty = db.session.execute(select(
+        ~select(Client.id).exists(), ~select(Product.id).exists(), ~select(Variant.id).exists()
+    )).one()
+    if all(empty):
+        # Insertions groupées (une requête par table, sans objets ORM)
+        db.session.execute(insert(Client), [{'name': c} for c in DEFAULT_CLIENTS])
+        db.session.execute(insert(Product), [{'name': n} for n in DEFAULT_PRODUCTS])
+        prods = dict(db.session.execute(select(Product.name, Product.id)).all())
+        db.session.execute(insert(Variant), [
+            {'product_id': prods[name], 'size_l': size, 'price_ttc': price}
+            for name, size, price in DEFAULT_VARIANTS
+        ])
         db.session.commit()
 
+def ensure_indexes():
+    # create_all() ignore les tables existantes : on ajoute les index manquants
+    for idx in Movement.__table__.indexes:
+        idx.create(bind=db.engine, checkfirst=True)
+
+# --- Requêtes d'agrégation (construites une fois, paramètres liés à l'exécution) ---
+_OUT_QTY = func.coalesce(func.sum(case((Movement.type=='OUT', Movement.qty), else_=0)),0)
+_IN_QTY = func.coalesce(func.sum(case((Movement.type=='IN', Movement.qty), else_=0)),0)
+
+MOVEMENTS_STAMP = select(func.coalesce(func.max(Movement.id), 0))
+
+STOCK_BY_CLIENT = select(
+    Client.id, Client.name,
+    _OUT_QTY.label('out_qty'),
+    _IN_QTY.label('in_qty'),
+    func.coalesce(func.sum(
+        case((Movement.type=='OUT', Movement.qty*Movement.deposit_per_keg),
+             else_=-Movement.qty*Movement.deposit_per_keg)
+    ),0).label('deposit_in_play')
+).join(Movement, Movement.client_id==Client.id, isouter=True)\
+ .group_by(Client.id, Client.name).order_by(Client.name)
+
+STOCK_BY_VARIANT = select(
+    Variant.id, Product.name.label('product_name'), Variant.size_l,
+    _OUT_QTY.label('out_qty'),
+    _IN_QTY.label('in_qty'),
+    func.min(Variant.price_ttc).label('catalog_price')
+).join(Product, Product.id==Variant.product_id)\
+ .join(Movement, Movement.variant_id==Variant.id, isouter=True)\
+ .where((Movement.client_id==bindparam('client_id')) | (Movement.client_id==None))\
+ .group_by(Variant.id, Product.name, Variant.size_l).order_by(Product.name, Variant.size_l)
+
+# Prix catalogue du format + existence du client : validation du formulaire en une requête
+VARIANT_FOR_CLIENT = select(
+    Variant.price_ttc,
+    select(Client.id).where(Client.id==bindparam('client_id')).exists().label('client_exists')
+).where(Variant.id==bindparam('variant_id'))
+
+def movements_stamp():
+    # Id du dernier mouvement, utilisé comme clé de cache. Fiable tant que les ids sont
+    # validés dans l'ordre : sur Postgres, deux POST concurrents peuvent valider N+1 avant N ;
+    # l'agrégat mis en cache sous N+1 ignore alors N jusqu'à l'expiration (TTL 60 s).
+    return db.session.scalar(MOVEMENTS_STAMP)
+
+@cache.memoize(timeout=60)
+def stock_by_client(stamp):
+    # Fûts et consignes en jeu par client
+    rows = db.session.execute(STOCK_BY_CLIENT).all()
+    return [dict(r._mapping) for r in rows]
+
+@cache.memoize(timeout=60)
+def stock_by_variant(client_id, stamp):
+    # Fûts chez un client, par produit/format
+    rows = db.session.execute(STOCK_BY_VARIANT, {'client_id': client_id}).all()
+    return [dict(r._mapping) for r in rows]
+
+# Clients et catalogue : tables quasi statiques (seed uniquement)
+@cache.memoize(timeout=300)
+def client_choices():
+    rows = db.session.execute(select(Client.id, Client.name).order_by(Client.name)).all()
+    return [dict(r._mapping) for r in rows]
+
+@cache.memoize(timeout=300)
+def variant_choices():
+    rows = db.session.execute(
+        select(Variant.id, Product.name, Variant.size_l, Variant.price_ttc)
+        .join(Product).order_by(Product.name, Variant.size_l)
+    ).all()
+    return [dict(r._mapping) for r in rows]
+
+def engine_options(uri):
+    # SQLite : pool par défaut ; autres bases : pool dimensionné + connexions vérifiées
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    if backend == 'sqlite':
+        return {'query_cache_size': 1200}
+    options = {
+        'query_cache_size': 1200,   # SQL compilé réutilisé entre requêtes (défaut : 500)
+        'pool_pre_ping': True,
+        'pool_recycle': 280,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': 5,
+    }
+    if backend == 'postgresql':
+        # Paramètres libpq : refusés par les pilotes des autres bases
+        connect_args = {
+            'options': '-c statement_timeout=5000',
+            # keepalive TCP : détecte les connexions coupées sans attendre une requête
+            'keepalives': 1, 'keepalives_idle': 30, 'keepalives_interval': 10, 'keepalives_count': 5,
+        }
+        if url.get_driver_name() == 'psycopg':
+            # psycopg 3 : requêtes préparées côté serveur après 5 exécutions
+            connect_args['prepare_threshold'] = 5
+        options['connect_args'] = connect_args
+    return options
+
+def _sqlite_pragmas(dbapi_conn, _):
+    # WAL : les lectures ne bloquent plus pendant un commit, fsync allégé
+    cur = dbapi_conn.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('PRAGMA synchronous=NORMAL')
+    cur.execute('PRAGMA temp_store=MEMORY')   # tris/GROUP BY temporaires en mémoire
+    cur.close()
+
+INT_MAX = 2**31 - 1               # borne d'une colonne Integer
+AMOUNT_MAX = Decimal('99999999.99')  # borne de Numeric(10, 2)
+QTY_MAX = 999                     # fûts par mouvement
+NOTES_MAX = 280                   # borne de Movement.notes (String(280))
+
+def form_int(f, name, default=0):
+    # Entier positif du formulaire : absent -> default, invalide ou trop grand (ex. '-1', 'abc') -> 0
+    raw = f.get(name)
+    if not raw:
+        return default
+    n = int(raw) if raw.isdecimal() else 0
+    return n if n <= INT_MAX else 0
+
+def form_str(f, name):
+    # Texte du formulaire sans espaces autour ; absent ou vide -> None
+    raw = f.get(name)
+    return (raw.strip() or None) if raw else None
+
+def form_decimal(f, name, default=None):
+    # Montant du formulaire : absent -> default ; ValueError si invalide, non fini, négatif ou hors Numeric(10, 2)
+    raw = form_str(f, name)
+    if raw is None:
+        return default
+    try:
+        d = Decimal(raw)
+    except InvalidOperation:
+        raise ValueError(name) from None
+    if not d.is_finite() or d < 0 or d > AMOUNT_MAX:
+        raise ValueError(name)
+    d = d.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)   # arrondi commercial au centime
+    if d > AMOUNT_MAX:                # 99999999.999 arrondi au centime
+        raise ValueError(name)
+    return d
+
+def conditional_page(html):
+    # ETag sur le corps (y compris messages flash) : 304 si la page n'a pas changé.
+    # Flask-Compress suffixe l'ETag envoyé (":gzip", ":br") après la vue :
+    # on compare donc le hash nu à celui que le navigateur renvoie.
+    resp = make_response(html)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    resp.add_etag()
+    etag, _ = resp.get_etag()
+    held_tags = request.if_none_match
+    if held_tags.star_tag:
+        matches = [(etag, False)]
+    else:
+        # as_set() perd le préfixe W/ : un validateur faible le reste dans le 304
+        strong = held_tags.as_set()
+        matches = [(held, held not in strong)
+                   for held in held_tags.as_set(include_weak=True)
+                   if held.split(':', 1)[0] == etag]
+    if matches:
+        held, weak = matches[0]
+        not_modified = make_response('', 304)
+        not_modified.headers['Cache-Control'] = resp.headers['Cache-Control']
+        not_modified.set_etag(held, weak=weak)
+        return not_modified
+    return resp
+
 def create_app():
     app = Flask(__name__)
+    # Templates compilés partagés entre workers et redémarrages (dossier temporaire)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'devkey')
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///data.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    if os.environ.get('REDIS_URL'):
+        # Cache partagé entre workers/instances
+        app.config['CACHE_TYPE'] = 'RedisCache'
+        app.config['CACHE_REDIS_URL'] = os.environ['REDIS_URL']
+    else:
+        app.config['CACHE_TYPE'] = 'SimpleCache'
+    app.config['CACHE_DEFAULT_TIMEOUT'] = 60
+    app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
     db.init_app(app)
+    cache.init_app(app)
+    compress.init_app(app)
 
     with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', _sqlite_pragmas)
         db.create_all()
+        ensure_indexes()
         seed_if_empty()
+        # gunicorn --preload : pas de connexion ouverte héritée par les workers
+        db.engine.dispose()
 
     @app.errorhandler(404)
     def not_found(e): 
@@ -73,69 +263,82 @@ def create_app():
 
     @app.route('/')
     def index():
-        rows = db.session.query(
-            Client.id, Client.name,
-            func.coalesce(func.sum(case((Movement.type=='OUT', Movement.qty), else_=0)),0).label('out_qty'),
-            func.coalesce(func.sum(case((Movement.type=='IN', Movement.qty), else_=0)),0).label('in_qty'),
-            func.coalesce(func.sum(
-                case((Movement.type=='OUT', Movement.qty*Movement.deposit_per_keg),
-                     else_=-Movement.qty*Movement.deposit_per_keg)
-            ),0.0).label('deposit_in_play')
-        ).join(Movement, Movement.client_id==Client.id, isouter=True)\
-         .group_by(Client.id, Client.name).order_by(Client.name).all()
-        return render_template('index.html', rows=rows)
+        return conditional_page(render_template('index.html', rows=stock_by_client(movements_stamp())))
 
     @app.route('/clients')
     def clients():
-        return render_template('clients.html', clients=Client.query.order_by(Client.name).all())
+        return render_template('clients.html', clients=client_choices())
 
     @app.route('/client/<int:client_id>')
     def client_detail(client_id):
-        client = Client.query.get_or_404(client_id)
-        q = db.session.query(
-            Variant.id, Product.name.label('product_name'), Variant.size_l,
-            func.coalesce(func.sum(case((Movement.type=='OUT', Movement.qty), else_=0)),0).label('out_qty'),
-            func.coalesce(func.sum(case((Movement.type=='IN', Movement.qty), else_=0)),0).label('in_qty'),
-            func.min(Variant.price_ttc).label('catalog_price')
-        ).join(Product, Product.id==Variant.product_id)\
-         .join(Movement, Movement.variant_id==Variant.id, isouter=True)\
-         .filter((Movement.client_id==client_id) | (Movement.client_id==None))\
-         .group_by(Variant.id, Product.name, Variant.size_l).order_by(Product.name, Variant.size_l)
-        rows = q.all()
-        return render_template('client_detail.html', client=client, rows=rows)
+        client = db.get_or_404(Client, client_id)
+        rows = stock_by_variant(client_id, movements_stamp())
+        return conditional_page(render_template('client_detail.html', client=client, rows=rows))
 
     @app.route('/movement/new', methods=['GET','POST'])
     def movement_new():
         if request.method == 'POST':
-            variant_id = int(request.form['variant_id'])
-            v = Variant.query.get_or_404(variant_id)
-            unit_price_raw = request.form.get('unit_price_ttc', '').strip()
-            unit_price = float(unit_price_raw) if unit_price_raw else (v.price_ttc if v.price_ttc is not None else None)
+            f = request.form
+            mtype = f.get('type')
+            client_id = form_int(f, 'client_id')
+            variant_id = form_int(f, 'variant_id')
+            qty = form_int(f, 'qty', 1)
+            notes = form_str(f, 'notes')
+            amounts_ok = True
+            try:
+                unit_price = form_decimal(f, 'unit_price_ttc')   # vide -> prix catalogue
+                deposit = form_decimal(f, 'deposit_per_keg', Decimal(30))
+            except ValueError:
+                amounts_ok = False
+            # Saisie invalide : on renvoie au formulaire avant toute requête
+            if mtype not in ('OUT', 'IN') or client_id <= 0 or variant_id <= 0 \
+                    or not 1 <= qty <= QTY_MAX or not amounts_ok \
+                    or (notes is not None and len(notes) > NOTES_MAX):
+                flash('Saisie invalide, mouvement non enregistré ❌')
+                return redirect(url_for('movement_new'))
+
+            found = db.session.execute(
+                VARIANT_FOR_CLIENT, {'client_id': client_id, 'variant_id': variant_id}
+            ).first()
+            if found is None or not found.client_exists:
+                abort(404)
+            if unit_price is None:
+                unit_price = found.price_ttc
 
             m = Movement(
-                type=request.form['type'],
-                client_id=int(request.form['client_id']),
+                type=mtype,
+                client_id=client_id,
                 variant_id=variant_id,
-                qty=int(request.form.get('qty', 1)),
+                qty=qty,
                 unit_price_ttc=unit_price,
-                deposit_per_keg=float(request.form.get('deposit_per_keg', 30) or 30),
-                notes=(request.form.get('notes','').strip() or None)
+                deposit_per_keg=deposit,
+                notes=notes
             )
             db.session.add(m)
             db.session.commit()
             flash('Mouvement enregistré ✅')
             return redirect(url_for('client_detail', client_id=m.client_id))
 
-        clients = Client.query.order_by(Client.name).all()
-        variants = db.session.query(Variant.id, Product.name, Variant.size_l, Variant.price_ttc)\
-                             .join(Product).order_by(Product.name, Variant.size_l).all()
-        return render_template('movement_new.html', clients=clients, variants=variants)
+        return render_template('movement_new.html', clients=client_choices(), variants=variant_choices())
+
+    @app.route('/health')
+    def health():
+        # Sonde Render : 503 seulement si la base est injoignable (erreur ou pool_timeout).
+        # La latence est indicative (journaux) : une lenteur passagère ne rend pas l'instance malade.
+        t0 = time.perf_counter()
+        try:
+            db.session.execute(select(1))
+        except SQLAlchemyError:
+            app.logger.exception('health: base injoignable')
+            return 'base injoignable', 503
+        ms = (time.perf_counter() - t0) * 1000
+        if ms >= 100:
+            app.logger.warning('health: SELECT 1 en %.0f ms', ms)
+        return f'ok ({ms:.0f} ms)', 200
 
     @app.route('/products')
     def products():
-        rows = db.session.query(Product.name, Variant.size_l, Variant.price_ttc)\
-                         .join(Variant).order_by(Product.name, Variant.size_l).all()
-        return render_template('products.html', rows=rows)
+        return render_template('products.html', rows=variant_choices())
 
     return app
 
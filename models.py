@@ -1,33 +1,42 @@
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"expire_on_commit": False})
 
 class Client(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
+    # lazy='raise' : charger explicitement (selectinload) si besoin
+    movements = db.relationship('Movement', back_populates='client', lazy='raise')
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
+    variants = db.relationship('Variant', back_populates='product', lazy='raise')
 
 class Variant(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
     size_l = db.Column(db.Integer, nullable=False)           # 20, 22, 30…
-    price_ttc = db.Column(db.Float, nullable=True)           # EUR TTC (facultatif)
-    product = db.relationship('Product', backref='variants')
+    price_ttc = db.Column(db.Numeric(10, 2), nullable=True)  # EUR TTC (facultatif)
+    product = db.relationship('Product', back_populates='variants', lazy='select')
 
 class Movement(db.Model):
+    __table_args__ = (
+        db.Index('ix_movement_client_type', 'client_id', 'type'),     # vue d'ensemble par client
+        db.Index('ix_movement_variant_client', 'variant_id', 'client_id'),  # détail client par format
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     type = db.Column(db.String(3), nullable=False)           # 'OUT' ou 'IN'
     client_id = db.Column(db.Integer, db.ForeignKey('client.id'), nullable=False)
     variant_id = db.Column(db.Integer, db.ForeignKey('variant.id'), nullable=False)
     qty = db.Column(db.Integer, default=1, nullable=False)
-    unit_price_ttc = db.Column(db.Float, nullable=True)      # prérempli selon Variant
-    deposit_per_keg = db.Column(db.Float, default=30.0, nullable=False)
+    unit_price_ttc = db.Column(db.Numeric(10, 2), nullable=True)  # prérempli selon Variant
+    deposit_per_keg = db.Column(db.Numeric(10, 2), default=30, nullable=False)
     notes = db.Column(db.String(280), nullable=True)
 
-    client = db.relationship('Client', backref='movements')
-    variant = db.relationship('Variant')
+    # lazy='raise' : passer selectinload(...) explicitement dans la requête
+    client = db.relationship('Client', back_populates='movements', lazy='raise')
+    variant = db.relationship('Variant', lazy='raise')
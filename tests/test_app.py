@@ -0,0 +1,153 @@
+import pytest
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'br'])
+def test_compressed_page_revalidates_with_304(client, encoding):
+    headers = {'Accept-Encoding': encoding}
+    first = client.get('/', headers=headers)
+    assert first.status_code == 200
+    assert first.headers['Content-Encoding'] == encoding
+    etag = first.headers['ETag']
+
+    again = client.get('/', headers={**headers, 'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+
+
+def test_uncompressed_page_revalidates_with_304(client):
+    first = client.get('/', headers={'Accept-Encoding': 'identity'})
+    again = client.get('/', headers={'Accept-Encoding': 'identity',
+                                     'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_weak_etag_stays_weak_in_304(client):
+    first = client.get('/', headers={'Accept-Encoding': 'gzip'})
+    weak = 'W/' + first.headers['ETag']
+    again = client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': weak})
+    assert again.status_code == 304
+    assert again.headers['ETag'] == weak
+
+
+def test_star_if_none_match_gets_304(client):
+    resp = client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': '*'})
+    assert resp.status_code == 304
+    assert resp.data == b''
+
+
+def test_stale_etag_gets_full_page(client):
+    resp = client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"stale:gzip"'})
+    assert resp.status_code == 200
+    assert resp.data
+
+
+def _movement_form(**overrides):
+    form = {'type': 'OUT', 'client_id': '1', 'variant_id': '1', 'qty': '1',
+            'deposit_per_keg': '30', 'unit_price_ttc': '', 'notes': ''}
+    form.update(overrides)
+    return form
+
+
+@pytest.mark.parametrize('field, value', [
+    ('deposit_per_keg', 'abc'),
+    ('deposit_per_keg', '-50'),
+    ('deposit_per_keg', '1e20'),
+    ('deposit_per_keg', '99999999.999'),
+    ('unit_price_ttc', 'abc'),
+    ('unit_price_ttc', 'NaN'),
+    ('unit_price_ttc', 'Infinity'),
+    ('qty', '0'),
+    ('qty', '1000'),
+    ('qty', '99999999999999999999999'),
+    ('client_id', '99999999999999999999999'),
+    ('notes', 'x' * 281),
+])
+def test_invalid_movement_input_redirects_to_form(client, field, value):
+    resp = client.post('/movement/new', data=_movement_form(**{field: value}))
+    assert resp.status_code == 302
+    assert resp.headers['Location'].endswith('/movement/new')
+
+
+def _stored_movement(notes):
+    from sqlalchemy import select
+    from app import app as flask_app
+    from models import db, Movement
+
+    with flask_app.app_context():
+        return db.session.execute(select(Movement).where(Movement.notes == notes)).scalar_one()
+
+
+def test_valid_movement_is_recorded(client):
+    from decimal import Decimal
+
+    resp = client.post('/movement/new', data=_movement_form(
+        unit_price_ttc='12.345', deposit_per_keg='30.005', notes='arrondi'))
+    assert resp.status_code == 302
+    assert resp.headers['Location'].endswith('/client/1')
+
+    m = _stored_movement('arrondi')
+    assert m.unit_price_ttc == Decimal('12.35')
+    assert m.deposit_per_keg == Decimal('30.01')
+
+
+def test_health_ok(client):
+    resp = client.get('/health')
+    assert resp.status_code == 200
+    assert resp.data.startswith(b'ok')
+
+
+def test_health_reports_503_when_database_fails(client, monkeypatch):
+    from sqlalchemy.exc import OperationalError
+    from models import db
+
+    def boom(*args, **kwargs):
+        raise OperationalError('SELECT 1', {}, Exception('down'))
+
+    monkeypatch.setattr(db.session, 'execute', boom)
+    resp = client.get('/health')
+    assert resp.status_code == 503
+
+
+def test_engine_options_libpq_args_only_for_postgres():
+    from app import engine_options
+
+    pg = engine_options('postgresql+psycopg://u:p@h/db')
+    assert pg['connect_args']['prepare_threshold'] == 5
+    assert 'statement_timeout' in pg['connect_args']['options']
+
+    assert 'prepare_threshold' not in engine_options('postgresql+psycopg2://u:p@h/db')['connect_args']
+
+    mysql = engine_options('mysql+pymysql://u:p@h/db')
+    assert 'connect_args' not in mysql
+    assert mysql['pool_pre_ping'] is True
+
+    assert engine_options('sqlite:///data.db') == {'query_cache_size': 1200}
+
+
+def _index_badges(client):
+    import re
+
+    html = client.get('/').get_data(as_text=True)
+    m = re.search(r'href="/client/1">.*?(-?\d+) fût\(s\).*?Consignes: (-?\d+) €', html, re.S)
+    return int(m.group(1)), int(m.group(2))
+
+
+def _detail_kegs(client):
+    import re
+
+    html = client.get('/client/1').get_data(as_text=True)
+    m = re.search(r'<td>Coreff Blonde</td>\s*<td>20 L</td>\s*'
+                  r'<td class="text-end"><span class="badge bg-secondary">(-?\d+)</span>', html)
+    return int(m.group(1)) if m else 0
+
+
+def test_cached_stock_refreshes_after_new_movement(client):
+    # Les agrégats sont mis en cache sous MAX(movement.id) : un nouveau mouvement doit changer la clé
+    kegs_before, deposit_before = _index_badges(client)
+    detail_before = _detail_kegs(client)
+
+    resp = client.post('/movement/new', data=_movement_form(qty='3', deposit_per_keg='30'))
+    assert resp.status_code == 302
+
+    assert _index_badges(client) == (kegs_before + 3, deposit_before + 90)
+    assert _detail_kegs(client) == detail_before + 3